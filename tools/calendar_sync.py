@@ -4,24 +4,48 @@
 
 """One-way synchronization of calendars (from Office 365 to Google)"""
 
-import os, sys, logging, datetime, time, sched, signal
+import os, sys, logging, datetime, time, signal, pickle, hashlib, struct
 from config import Config
 from common import debug
 from argparse import ArgumentParser, HelpFormatter
 from o365_oauth import Office365Credentials, Office365ExchangeAccount
 from google_oauth import GoogleCredentials
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from exchangelib.ewsdatetime import EWSDateTime, EWSTimeZone
 from exchangelib.folders.known_folders import Calendar
-from dateutil.rrule import rrule, WEEKLY
+from exchangelib.errors import ErrorInvalidSyncStateData
 from threading import Thread
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, partial
+from itertools import chain
 
 LOGGER = logging.getLogger(__name__)
 PAST_EVENTS = datetime.timedelta(days = 7)
 FUTURE_EVENTS = datetime.timedelta(days = 28)
+CACHE_MARGIN = datetime.timedelta(days = 7)
+CACHE_VERSION = 1
 GOOGLE_RETRIES = 10
+GOOGLE_BATCH_SIZE = 50
+GOOGLE_MAX_RESULTS = 2500
+GOOGLE_EVENT_FIELDS = 'nextPageToken,nextSyncToken,' \
+    'items(id,etag,status,summary,description,start/dateTime,end/dateTime)'
+EXCHANGE_EVENT_FIELDS = ['start', 'end', 'subject', 'text_body', 'is_all_day']
+EXCHANGE_VIEW_RANGE = datetime.timedelta(weeks = 1)
+EXCHANGE_WORKERS = 8
 SYNC_INTERVAL_SEC = 300
+RECONCILE_TICKS = 12
+
+def digest(*parts):
+    blake2b = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        part = part.encode() if isinstance(part, str) else struct.pack('<q', part)
+        blake2b.update(len(part).to_bytes(4, 'little') + part)
+    return blake2b.digest()
+
+def parse_datetime(value):
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
 
 class ExchangeCalendar:
     def __init__(self, config_file, calendar_name):
@@ -30,97 +54,234 @@ class ExchangeCalendar:
 
     @debug('Logged in to Office 365')
     def login(self):
-        config = Config(self.config_file).load()
-        credentials = Office365Credentials(config).login()
+        self.config = Config(self.config_file).load()
+        credentials = Office365Credentials(self.config).login()
         self.account = Office365ExchangeAccount(credentials).build()
         self.calendar = self.calendar_by_name(self.calendar_name)
         self.tz = EWSTimeZone.localzone()
+        self.cache = None
+        self.fingerprints = {}
         return self
 
     def calendar_by_name(self, name):
         if name == 'Calendar':
             return self.account.calendar
-        else:
-            for folder in self.account.root.walk().get_folders():
-                if isinstance(folder, Calendar) and folder.name == name:
+        calendar_ids = self.config.get('calendar_ids', {})
+        if name in calendar_ids:
+            try:
+                folder = Calendar(root=self.account.root, id=calendar_ids[name])
+                folder.refresh()
+                if folder.name == name:
                     return folder
-            raise Exception(f'No such Exchange calendar: {name}')
+            except Exception as e:
+                LOGGER.debug('Cached Exchange calendar id is invalid: %s', str(e))
+        for folder in self.account.root.walk().get_folders():
+            if isinstance(folder, Calendar) and folder.name == name:
+                calendar_ids[name] = folder.id
+                self.config.set('calendar_ids', calendar_ids).save()
+                return folder
+        raise Exception(f'No such Exchange calendar: {name}')
 
     @debug(lambda e: 'Fetched %d events from Office 365 calendar' % len(e), True)
     def events(self, start, end):
         try:
-            events = []
-            timerange = rrule(freq=WEEKLY, dtstart=start, until=end)
-            for range_start, range_end in zip(timerange, timerange[1:]):
-                events.extend([event for event in list(self.calendar.view(
-                    start = EWSDateTime.from_datetime(range_start).astimezone(self.tz),
-                    end = EWSDateTime.from_datetime(range_end).astimezone(self.tz))
-                ) if not event.is_all_day])
-            return events
+            if self.changed():
+                self.cache = None
+            if not self.cache or start < self.cache['start'] or end > self.cache['end']:
+                timerange = [start + EXCHANGE_VIEW_RANGE * i
+                    for i in range((end + CACHE_MARGIN - start) // EXCHANGE_VIEW_RANGE + 1)]
+                with ThreadPoolExecutor(max_workers=EXCHANGE_WORKERS) as executor:
+                    events = list(chain.from_iterable(
+                        executor.map(self.view, timerange, timerange[1:])
+                    ))
+                self.cache = { 'start': start, 'end': timerange[-1], 'events': events }
+                keys = {(event.id, event.changekey) for event in events}
+                self.fingerprints = {
+                    key: fp for key, fp in self.fingerprints.items() if key in keys
+                }
+            return [event for event in self.cache['events']
+                if event.end > start and event.start < end]
 	    # TODO: https://github.com/ecederstrand/exchangelib/issues/109#issuecomment-311041273
         except Exception as e:
-            LOGGER.error('Failed to fetch Office 365 events:', str(e))
+            LOGGER.error('Failed to fetch Office 365 events: %s', str(e))
+
+    def view(self, start, end):
+        return [event for event in self.calendar.view(
+            start = EWSDateTime.from_datetime(start).astimezone(self.tz),
+            end = EWSDateTime.from_datetime(end).astimezone(self.tz)
+        ).only(*EXCHANGE_EVENT_FIELDS) if not event.is_all_day]
+
+    def changed(self):
+        sync_states = self.config.get('sync_states', {})
+        self.calendar.item_sync_state = sync_states.get(self.calendar_name)
+        try:
+            changes = list(self.calendar.sync_items(only_fields=['id', 'changekey']))
+        except ErrorInvalidSyncStateData:
+            LOGGER.debug('Office 365 sync state expired, performing full sync')
+            self.calendar.item_sync_state = None
+            changes = list(self.calendar.sync_items(only_fields=['id', 'changekey']))
+        if self.calendar.item_sync_state != sync_states.get(self.calendar_name):
+            sync_states[self.calendar_name] = self.calendar.item_sync_state
+            self.config.set('sync_states', sync_states).save()
+        return len(changes) > 0
 
     def fingerprint(self, event):
-        return hash('|'.join((
-            event.start.astimezone(self.tz).isoformat(),
-            event.end.astimezone(self.tz).isoformat(),
-            event.subject,
-            event.text_body or ''
-        )))
+        key = (event.id, event.changekey)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = digest(
+                int(event.start.timestamp()),
+                int(event.end.timestamp()),
+                event.subject or '',
+                event.text_body or ''
+            )
+        return self.fingerprints[key]
 
 class GoogleCalendar:
     def __init__(self, config_file, calendar_name):
         self.config_file = config_file
         self.calendar_name = calendar_name
+        self.cache_file = os.path.splitext(config_file)[0] + '.cache'
 
     @debug('Logged in to Google')
     def login(self):
-        config = Config(self.config_file).load()
-        credentials = GoogleCredentials(config).login()
+        from googleapiclient.discovery import build
+
+        self.config = Config(self.config_file).load()
+        credentials = GoogleCredentials(self.config).login()
         self.account = build('calendar', 'v3', credentials=credentials)
         self.calendar = self.calendar_by_name(self.calendar_name)
         self.tz = datetime.datetime.now().astimezone().tzinfo
+        self.cache = self.load_cache()
         return self
 
     def calendar_by_name(self, name):
+        calendar_ids = self.config.get('calendar_ids', {})
+        if name in calendar_ids:
+            try:
+                calendar = self.account.calendarList().get(
+                    calendarId=calendar_ids[name]
+                ).execute(num_retries=GOOGLE_RETRIES)
+                if self.has_name(calendar, name):
+                    return calendar
+            except HttpError as e:
+                LOGGER.debug('Cached Google calendar id is invalid: %s', str(e))
         page_token = None
         while True:
             calendar_list = self.account.calendarList().list(
                 pageToken=page_token
             ).execute(num_retries=GOOGLE_RETRIES)
             for calendar in calendar_list['items']:
-                if calendar.get('summary') == name \
-                or calendar.get('summaryOverride') == name \
-                or (name == 'primary' and calendar.get('primary') == True):
+                if self.has_name(calendar, name):
+                    calendar_ids[name] = calendar.get('id')
+                    self.config.set('calendar_ids', calendar_ids).save()
                     return calendar
             page_token = calendar_list.get('nextPageToken')
             if not page_token:
                 raise Exception(f'No such Google calendar: {name}')
 
+    def has_name(self, calendar, name):
+        return calendar.get('summary') == name \
+            or calendar.get('summaryOverride') == name \
+            or (name == 'primary' and calendar.get('primary') == True)
+
     @debug(lambda e: 'Fetched %d events from Google calendar' % len(e), True)
-    def events(self, start, end):
-        events, page_token = [], None
+    def events(self, start, end, refresh=True):
+        if not self.cache or start < self.cache['start'] or end > self.cache['end']:
+            self.cache = None
+        elif refresh:
+            try:
+                self.fetch(self.cache, syncToken=self.cache['sync_token'])
+                self.save_cache()
+            except HttpError as e:
+                if e.resp.status != 410:
+                    raise
+                LOGGER.debug('Google sync token expired, performing full sync')
+                self.cache = None
+        if not self.cache:
+            cache = {
+                'version': CACHE_VERSION,
+                'calendar_id': self.calendar.get('id'),
+                'start': start,
+                'end': end + CACHE_MARGIN,
+                'events': {}
+            }
+            self.fetch(cache,
+                timeMin=start.astimezone(self.tz).isoformat(),
+                timeMax=cache['end'].astimezone(self.tz).isoformat()
+            )
+            self.cache = cache
+            self.save_cache()
+        return [event for event in self.cache['events'].values()
+            if self.within(event, start, end)]
+
+    def fetch(self, cache, **kwargs):
+        page_token = None
         while True:
             event_list = self.account.events().list(
                 pageToken=page_token,
                 calendarId=self.calendar.get('id'),
-                timeMin=start.astimezone(self.tz).isoformat(),
-                timeMax=end.astimezone(self.tz).isoformat(),
-                timeZone=self.tz
+                timeZone=self.tz,
+                maxResults=GOOGLE_MAX_RESULTS,
+                fields=GOOGLE_EVENT_FIELDS,
+                **kwargs
             ).execute(num_retries=GOOGLE_RETRIES)
-            events.extend(event_list['items'])
+            for event in event_list['items']:
+                if event.get('status') == 'cancelled':
+                    cache['events'].pop(event['id'], None)
+                else:
+                    cache['events'][event['id']] = event
             page_token = event_list.get('nextPageToken')
             if not page_token:
-                return events
+                cache['sync_token'] = event_list.get('nextSyncToken')
+                return
+
+    def within(self, event, start, end):
+        event_start = event.get('start', {}).get('dateTime')
+        event_end = event.get('end', {}).get('dateTime')
+        return event_start and event_end \
+            and parse_datetime(event_end) > start \
+            and parse_datetime(event_start) < end
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+            if cache.get('version') == CACHE_VERSION \
+            and cache.get('calendar_id') == self.calendar.get('id'):
+                return cache
+        except Exception:
+            pass
+        return None
+
+    def save_cache(self):
+        if self.cache:
+            with open(self.cache_file, 'wb') as cache_file:
+                pickle.dump(self.cache, cache_file)
+
+    def update_cache(self, event, fingerprint=None, deleted=False):
+        if not self.cache:
+            return
+        if deleted:
+            self.cache['events'].pop(event['id'], None)
+        else:
+            if fingerprint:
+                event['_fingerprint'] = fingerprint
+            self.cache['events'][event['id']] = event
+
+    def invalidate_cache(self):
+        self.cache = None
+        if os.path.isfile(self.cache_file):
+            os.remove(self.cache_file)
 
     def fingerprint(self, event):
-        return hash('|'.join((
-            event.get('start').get('dateTime'),
-            event.get('end').get('dateTime'),
-            event.get('summary'),
-            event.get('description', '')
-        )))
+        if '_fingerprint' not in event:
+            event['_fingerprint'] = digest(
+                int(parse_datetime(event.get('start').get('dateTime')).timestamp()),
+                int(parse_datetime(event.get('end').get('dateTime')).timestamp()),
+                event.get('summary', ''),
+                event.get('description', '')
+            )
+        return event['_fingerprint']
 
     def create(self, start, end, subject, **kwargs):
         event = {
@@ -130,27 +291,22 @@ class GoogleCalendar:
         }
         if kwargs.get('description'):
             event['description'] = kwargs.get('description')
-        event = self.account.events().insert(
+        return self.account.events().insert(
             calendarId=self.calendar.get('id'),
             body=event
-        ).execute(num_retries=GOOGLE_RETRIES)
-        LOGGER.debug('Event created: %s, %s (%s)',
-            subject, start.isoformat(), event['htmlLink']
         )
 
     def delete(self, event):
-        self.account.events().delete(
+        return self.account.events().delete(
             calendarId=self.calendar.get('id'),
             eventId=event.get('id')
-        ).execute(num_retries=GOOGLE_RETRIES)
-        LOGGER.debug(f'Event deleted: %s, %s',
-            event['summary'], event['start']['dateTime']
         )
 
 class CalendarSync:
     def __init__(self, source_calendar, target_calendar):
         self.source_calendar = source_calendar
         self.target_calendar = target_calendar
+        self.ticks = 0
 
     def asynchronous(func):
         @wraps(func)
@@ -162,46 +318,91 @@ class CalendarSync:
 
     def schedule(interval):
         def decorator(func, *args, **kwargs):
-            def periodic(scheduler, interval, action, args=(), kwargs={}):
-                scheduler.enter(interval, 1, periodic,
-                    (scheduler, interval, action, args, kwargs))
-                action(*args, **kwargs)
-
             @wraps(func)
             def wrapper(*args, **kwargs):
-                scheduler = sched.scheduler(time.time, time.sleep)
-                periodic(scheduler, interval, func, args, kwargs)
-                scheduler.run()
+                while True:
+                    start = time.monotonic()
+                    try:
+                        func(*args, **kwargs)
+                    except Exception:
+                        LOGGER.exception('Calendar sync failed')
+                    time.sleep(max(0, interval - (time.monotonic() - start)))
             return wrapper
         return decorator
 
     @asynchronous
     @schedule(SYNC_INTERVAL_SEC)
     def run(self):
-        now = datetime.datetime.utcnow()
+        now = datetime.datetime.now(datetime.timezone.utc)
         start, end = now - PAST_EVENTS, now + FUTURE_EVENTS
         LOGGER.debug(f'Time window: {start} .. {end}')
 
-        source_events = self.event_map(self.source_calendar, start, end)
+        refresh = self.ticks % RECONCILE_TICKS == 0
+        self.ticks += 1
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_future = executor.submit(self.event_map, self.source_calendar, start, end)
+            target_future = executor.submit(self.event_map, self.target_calendar, start, end,
+                refresh=refresh)
+            source_events, target_events = source_future.result(), target_future.result()
         if source_events == None: return
-        target_events = self.event_map(self.target_calendar, start, end)
         if target_events == None: return
-        for fingerprint, source_event in source_events.items():
-            if fingerprint in target_events:
-                del target_events[fingerprint]
-            else:
+        changes = []
+        for fingerprint in source_events.keys() - target_events.keys():
+            source_event = source_events[fingerprint]
+            event_start = source_event.start.astimezone(self.source_calendar.tz)
+            changes.append((
                 self.target_calendar.create(
-                    source_event.start.astimezone(self.source_calendar.tz),
+                    event_start,
                     source_event.end.astimezone(self.source_calendar.tz),
                     source_event.subject,
                     description = source_event.text_body or None
-                )
-        for fingerprint, target_event in target_events.items():
-            self.target_calendar.delete(target_event)
+                ),
+                partial(self._created, fingerprint, source_event.subject, event_start.isoformat())
+            ))
+        for fingerprint in target_events.keys() - source_events.keys():
+            target_event = target_events[fingerprint]
+            changes.append((
+                self.target_calendar.delete(target_event),
+                partial(self._deleted, target_event)
+            ))
+        self.execute(changes)
+
+    def execute(self, changes):
+        for offset in range(0, len(changes), GOOGLE_BATCH_SIZE):
+            batch = self.target_calendar.account.new_batch_http_request()
+            for request, callback in changes[offset:offset + GOOGLE_BATCH_SIZE]:
+                batch.add(request, callback=callback)
+            try:
+                batch.execute()
+            except Exception:
+                self.target_calendar.invalidate_cache()
+                raise
+        if changes:
+            self.target_calendar.save_cache()
+
+    def _created(self, fingerprint, subject, start, request_id, response, exception):
+        if exception:
+            LOGGER.error('Event not created: %s, %s (%s)', subject, start, exception)
+            self.target_calendar.invalidate_cache()
+        else:
+            self.target_calendar.update_cache(response, fingerprint)
+            LOGGER.debug('Event created: %s, %s (%s)', subject, start, response['htmlLink'])
+
+    def _deleted(self, event, request_id, response, exception):
+        if exception:
+            LOGGER.error('Event not deleted: %s, %s (%s)',
+                event['summary'], event['start']['dateTime'], exception
+            )
+            self.target_calendar.invalidate_cache()
+        else:
+            self.target_calendar.update_cache(event, deleted=True)
+            LOGGER.debug('Event deleted: %s, %s',
+                event['summary'], event['start']['dateTime']
+            )
 
-    def event_map(self, calendar, start, end):
+    def event_map(self, calendar, start, end, **kwargs):
         return {
-            calendar.fingerprint(event): event for event in calendar.events(start, end)
+            calendar.fingerprint(event): event for event in calendar.events(start, end, **kwargs)
         }
 
 def exit_gracefully(*args):
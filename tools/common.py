@@ -11,14 +11,19 @@ def debug(msg, runtime=False):
     def decorator(func, *args, **kwargs):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            if not LOGGER.isEnabledFor(logging.DEBUG):
+                return func(*args, **kwargs)
             start = time.monotonic()
             result = func(*args, **kwargs)
-            delta = datetime.timedelta(seconds=time.monotonic() - start)
-            duration = ' (duration: {})'.format(delta) if runtime else ''
+            if runtime:
+                delta = datetime.timedelta(seconds=time.monotonic() - start)
+                duration = ' (duration: %s)' % delta
+            else:
+                duration = ''
             if not callable(msg):
-                LOGGER.debug(msg + duration)
+                LOGGER.debug('%s%s', msg, duration)
             elif result != None:
-                LOGGER.debug(msg(result) + duration)
+                LOGGER.debug('%s%s', msg(result), duration)
             return result
         return wrapper
     return decorator
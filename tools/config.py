@@ -2,7 +2,12 @@
 # Copyright (c) 2022-2023 Sandor Balazsi (sandor.balazsi@gmail.com)
 # vim: ts=4:sw=4:sts=4:et
 
-import json
+import os, json, shutil, tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class Config:
     def __init__(self, filename):
@@ -10,17 +15,25 @@ class Config:
         self.config = {}
 
     def load(self):
-        with open(self.filename, 'r') as json_file:
-            self.config = json.load(json_file)
+        with open(self.filename, 'rb') as json_file:
+            self.config = (orjson or json).loads(json_file.read())
         return self
 
     def save(self):
-        with open(self.filename, 'w') as json_file:
-            json.dump(self.config, json_file, indent=2)
+        if orjson:
+            content = orjson.dumps(self.config, option=orjson.OPT_INDENT_2)
+        else:
+            content = json.dumps(self.config, indent=2).encode()
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.')
+        with os.fdopen(fd, 'wb') as json_file:
+            json_file.write(content)
+        if os.path.exists(self.filename):
+            shutil.copymode(self.filename, temp_filename)
+        os.replace(temp_filename, self.filename)
         return self
 
     def has(self, key):
-        return key in self.config.keys()
+        return key in self.config
 
     def get(self, key, default=None):
         return self.config.get(key, default)
@@ -4,22 +4,37 @@
 
 """Office 365 Interactive OAuth 2.0"""
 
-import os, sys, logging, time, requests, json
+import os, sys, logging, requests, json
 from config import Config
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote_plus
 from argparse import ArgumentParser, HelpFormatter
 from oauthlib.oauth2 import WebApplicationClient
 from exchangelib import Account, Configuration, FaultTolerance, DELEGATE
 from exchangelib.protocol import BaseProtocol, Protocol
 from exchangelib.credentials import BaseOAuth2Credentials
-from cached_property import threaded_cached_property
+from functools import cached_property
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 LOGGER = logging.getLogger(__name__)
 EXCHANGE_SERVER = 'outlook.office365.com'
-REDIRECT_URI = 'https://login.microsoftonline.com/common/oauth2/nativeclient'
+RESOURCE = f'https://{EXCHANGE_SERVER}'
+LOGIN_URL = 'https://login.microsoftonline.com'
+REDIRECT_URI = f'{LOGIN_URL}/common/oauth2/nativeclient'
+AUTHORIZE_PARAMS = '&response_type=code&response_mode=query' \
+    f'&redirect_uri={quote_plus(REDIRECT_URI)}&resource={quote_plus(RESOURCE)}'
 USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:107.0) Gecko/20100101 Firefox/107.0'
 RETRY_POLICY_MAX_WAIT_SEC = 3600
+AUTHORIZE_TIMEOUT_SEC = 1800
+AUTHORIZE_POLL_SEC = 0.1
+SESSION_POOL_SIZE = 10
 BaseProtocol.USERAGENT = USER_AGENT
 BaseProtocol.TIMEOUT = RETRY_POLICY_MAX_WAIT_SEC
+BaseProtocol.SESSION_POOLSIZE = SESSION_POOL_SIZE
 
 class Office365Credentials(BaseOAuth2Credentials):
     def __init__(self, config):
@@ -30,6 +45,8 @@ class Office365Credentials(BaseOAuth2Credentials):
         )
         self.config = config
         self.refresh_token = config.get('refresh_token')
+        self.http_session = requests.Session()
+        self.http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
     def login(self):
         if self.config.has('refresh_token'):
@@ -44,8 +61,7 @@ class Office365Credentials(BaseOAuth2Credentials):
 
     def refresh(self, session=None):
         super().refresh(session)
-        response = requests.post('https://login.microsoftonline.com/' \
-                '{}/oauth2/token'.format(self.tenant_id),
+        response = self.http_session.post(self.token_url,
             headers={
                  'User-Agent': USER_AGENT
             },
@@ -54,10 +70,10 @@ class Office365Credentials(BaseOAuth2Credentials):
                 'client_id': self.client_id,
                 'refresh_token': self.refresh_token,
                 'redirect_uri': REDIRECT_URI,
-                'resource': f'https://{EXCHANGE_SERVER}'
+                'resource': RESOURCE
             }
         )
-        response_json = json.loads(response.content)
+        response_json = (orjson or json).loads(response.content)
         if not response.ok:
             LOGGER.error(response_json['error_description'])
             response.raise_for_status()
@@ -72,6 +88,7 @@ class Office365Credentials(BaseOAuth2Credentials):
 
     def authorize(self):
         from subprocess import Popen, DEVNULL
+        from marionette_driver import Wait
         from marionette_driver.marionette import Marionette
         from urllib.parse import urlparse, parse_qs
 
@@ -83,39 +100,28 @@ class Office365Credentials(BaseOAuth2Credentials):
         firefox = Marionette()
         firefox.start_session()
         firefox.navigate(self.authorization_url())
-        while True:
-            url = firefox.get_url()
-            if url.startswith(REDIRECT_URI):
-                code = parse_qs(urlparse(url).query)['code'][0]
-                break
-            time.sleep(1)
-        firefox.delete_session()
-        firefox_process.terminate()
-        return code
+
+        def redirected(marionette):
+            url = marionette.get_url()
+            return url if url.startswith(REDIRECT_URI) else None
+
+        try:
+            url = Wait(firefox, timeout=AUTHORIZE_TIMEOUT_SEC, interval=AUTHORIZE_POLL_SEC) \
+                .until(redirected)
+            return parse_qs(urlparse(url).query)['code'][0]
+        finally:
+            firefox.delete_session()
+            firefox_process.terminate()
 
     def authorization_url(self):
-        from urllib.parse import quote_plus
-
-        return 'https://login.microsoftonline.com/' \
-                '{tenant_id}/oauth2/authorize' \
-                '?client_id={client_id}' \
-                '&login_hint={login_hint}' \
-                '&response_type={response_type}' \
-                '&response_mode={response_mode}' \
-                '&redirect_uri={redirect_uri}' \
-                '&resource={resource}'.format(
-            tenant_id=self.config.get('tenant_id'),
-            client_id=self.config.get('client_id'),
-            login_hint=quote_plus(self.config.get('email_address')),
-            response_type='code',
-            response_mode='query',
-            redirect_uri=quote_plus(REDIRECT_URI),
-            resource=quote_plus(f'https://{EXCHANGE_SERVER}')
-        )
+        return f'{LOGIN_URL}/{self.tenant_id}/oauth2/authorize' \
+            f'?client_id={self.client_id}' \
+            f'&login_hint={quote_plus(self.config.get("email_address"))}' \
+            + AUTHORIZE_PARAMS
 
     @property
     def token_url(self):
-        return f'https://login.microsoftonline.com/{self.tenant_id}/oauth2/token'
+        return f'{LOGIN_URL}/{self.tenant_id}/oauth2/token'
 
     @property
     def scope(self):
@@ -131,12 +137,12 @@ class Office365Credentials(BaseOAuth2Credentials):
 
     def token_params(self):
         params = super().token_params()
-        if self.code:
-            params['code'] = self.code
-            self.code = None
+        code = self.__dict__.pop('code', None)
+        if code is not None:
+            params['code'] = code
         return params
 
-    @threaded_cached_property
+    @cached_property
     def client(self):
         return WebApplicationClient(client_id=self.client_id)
 
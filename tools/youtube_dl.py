@@ -4,19 +4,18 @@
 
 """Download YouTube videos that have been added to a particular playlist"""
 
-import os, sys, logging, time, sched, signal, subprocess
+import os, sys, logging, time, signal
 from config import Config
 from common import debug
 from argparse import ArgumentParser, HelpFormatter
 from google_oauth import GoogleCredentials
-from googleapiclient.discovery import build
-from threading import Thread
-from functools import wraps
+from functools import wraps, partial
 
 LOGGER = logging.getLogger(__name__)
 GOOGLE_RETRIES = 10
+GOOGLE_BATCH_SIZE = 50
 SYNC_INTERVAL_SEC = 300
-DOWNLOAD_CMD = ['yt-dlp', '-S', 'ext:mp4:m4a']
+DOWNLOAD_FORMAT_SORT = ['ext:mp4:m4a']
 
 class YouTube:
     def __init__(self, config_file):
@@ -24,12 +23,23 @@ class YouTube:
 
     @debug('Logged in to Google')
     def login(self):
-        config = Config(self.config_file).load()
-        credentials = GoogleCredentials(config).login()
+        from googleapiclient.discovery import build
+
+        self.config = Config(self.config_file).load()
+        credentials = GoogleCredentials(self.config).login()
         self.youtube = build('youtube', 'v3', credentials=credentials)
         return self
 
     def playlist_by_name(self, name):
+        playlist_ids = self.config.get('playlist_ids', {})
+        if name in playlist_ids:
+            response = self.youtube.playlists().list(
+                part="snippet,contentDetails",
+                id=playlist_ids[name]
+            ).execute(num_retries=GOOGLE_RETRIES)
+            for playlist in response.get('items', []):
+                if playlist.get('snippet', {}).get('title') == name:
+                    return playlist
         page_token = None
         while True:
             response = self.youtube.playlists().list(
@@ -39,6 +49,8 @@ class YouTube:
             ).execute(num_retries=GOOGLE_RETRIES)
             for playlist in response.get('items', []):
                 if playlist.get('snippet', {}).get('title') == name:
+                    playlist_ids[name] = playlist.get('id')
+                    self.config.set('playlist_ids', playlist_ids).save()
                     return playlist
             page_token = response.get('nextPageToken')
             if not page_token:
@@ -58,59 +70,67 @@ class YouTube:
             if not page_token:
                 return items
 
-    @debug(lambda i: 'Delete playlist item: %s (%s)' % (i.get('snippet').get('title'),
-            i.get('snippet').get('resourceId').get('videoId')))
-    def playlist_item_delete(self, playlist_item):
-        self.youtube.playlistItems().delete(
-            id=playlist_item.get('id')
-        ).execute(num_retries=GOOGLE_RETRIES)
-        return playlist_item
+    def playlist_items_delete(self, playlist_items):
+        for offset in range(0, len(playlist_items), GOOGLE_BATCH_SIZE):
+            batch = self.youtube.new_batch_http_request()
+            for playlist_item in playlist_items[offset:offset + GOOGLE_BATCH_SIZE]:
+                batch.add(
+                    self.youtube.playlistItems().delete(id=playlist_item.get('id')),
+                    callback=partial(self._deleted, playlist_item)
+                )
+            batch.execute()
+
+    def _deleted(self, playlist_item, request_id, response, exception):
+        title = playlist_item.get('snippet').get('title')
+        video_id = playlist_item.get('snippet').get('resourceId').get('videoId')
+        if exception:
+            LOGGER.error('Playlist item not deleted: %s (%s): %s', title, video_id, exception)
+        else:
+            LOGGER.debug('Delete playlist item: %s (%s)', title, video_id)
 
 class YouTubeDownload:
     def __init__(self, youtube, playlist_name, target_folder):
+        from yt_dlp import YoutubeDL
+
         self.youtube = youtube
         self.playlist_id = youtube.playlist_by_name(playlist_name).get('id')
         self.target_folder = target_folder
-
-    def asynchronous(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            thread = Thread(target=func, args=args, kwargs=kwargs)
-            thread.start()
-            return thread
-        return wrapper
+        self.downloader = YoutubeDL({
+            'format_sort': DOWNLOAD_FORMAT_SORT,
+            'paths': { 'home': os.path.expanduser(target_folder) },
+            'quiet': True,
+            'noprogress': True
+        })
 
     def schedule(interval):
         def decorator(func, *args, **kwargs):
-            def periodic(scheduler, interval, action, args=(), kwargs={}):
-                scheduler.enter(interval, 1, periodic,
-                    (scheduler, interval, action, args, kwargs))
-                action(*args, **kwargs)
-
             @wraps(func)
             def wrapper(*args, **kwargs):
-                scheduler = sched.scheduler(time.time, time.sleep)
-                periodic(scheduler, interval, func, args, kwargs)
-                scheduler.run()
+                while True:
+                    start = time.monotonic()
+                    try:
+                        func(*args, **kwargs)
+                    except Exception:
+                        LOGGER.exception('Playlist download failed')
+                    time.sleep(max(0, interval - (time.monotonic() - start)))
             return wrapper
         return decorator
 
-    @asynchronous
     @schedule(SYNC_INTERVAL_SEC)
     def run(self):
-        for item in self.youtube.playlist_items(self.playlist_id):
-            self.download(item.get('snippet').get('resourceId').get('videoId'))
-            self.youtube.playlist_item_delete(item)
-
-    @debug(lambda p: 'Performing command: %s' % ' '.join(p.args), True)
+        downloaded = []
+        try:
+            for item in self.youtube.playlist_items(self.playlist_id):
+                self.download(item.get('snippet').get('resourceId').get('videoId'))
+                downloaded.append(item)
+        finally:
+            self.youtube.playlist_items_delete(downloaded)
+
+    @debug(lambda u: 'Downloaded video: %s' % u, True)
     def download(self, video_id):
-        return subprocess.run(
-            DOWNLOAD_CMD + ['https://youtu.be/' + video_id],
-            cwd=self.target_folder,
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
+        url = 'https://youtu.be/' + video_id
+        self.downloader.download([url])
+        return url
 
 def exit_gracefully(*args):
     LOGGER.debug('Exiting...')